@@ -5,11 +5,14 @@ Gemini File Search API 範例程式
 建立知識庫並進行語義查詢。
 """
 
+import io
 import mimetypes
 import os
 import time
+import weakref
 from datetime import datetime
 from pathlib import Path
+from typing import Iterator
 
 from dotenv import load_dotenv
 from google import genai
@@ -45,6 +48,15 @@ class FileSearchManager:
         self.client = genai.Client(api_key=api_key)
         self.store_name: str | None = None
 
+        # Manager 被回收時自動關閉 Client 連線 (finalizer 只持有 client，不持有 self)
+        client_close = getattr(self.client, "close", None)
+        self._finalizer = weakref.finalize(self, client_close) if client_close else None
+
+    def close(self) -> None:
+        """關閉底層 GenAI Client 的連線 (重複呼叫無副作用)。"""
+        if self._finalizer:
+            self._finalizer()
+
     def create_store(self, display_name: str) -> str:
         """建立新的 File Search Store。
 
@@ -123,7 +135,39 @@ class FileSearchManager:
             上傳的檔案資源名稱
         """
         display_name = display_name or Path(file_path).name
+        return self._upload(store_name, file_path, display_name, mime_type, poll_interval)
+
+    def upload_file_stream(
+        self,
+        store_name: str,
+        fileobj: io.IOBase,
+        display_name: str,
+        mime_type: str | None = None,
+        poll_interval: float = 5.0,
+    ) -> str:
+        """直接以 file-like 物件上傳檔案到 Store，不經過暫存檔。
+
+        Args:
+            store_name: Store 資源名稱
+            fileobj: 可讀取的 file-like 物件
+            display_name: 檔案顯示名稱（用於判斷 MIME 類型）
+            mime_type: MIME 類型（選填，自動偵測）
+            poll_interval: 輪詢間隔秒數
+
+        Returns:
+            上傳的檔案資源名稱
+        """
+        return self._upload(store_name, fileobj, display_name, mime_type, poll_interval)
 
+    def _upload(
+        self,
+        store_name: str,
+        file: str | io.IOBase,
+        display_name: str,
+        mime_type: str | None,
+        poll_interval: float,
+    ) -> str:
+        """上傳檔案 (路徑或 file-like 物件) 並等待處理完成。"""
         # 優先根據副檔名判定 MIME Type，確保相容性
         # 注意：file_path 可能是暫存檔 (無副檔名)，所以要用 display_name
         ext = Path(display_name).suffix.lower()
@@ -155,7 +199,7 @@ class FileSearchManager:
         log(f"上傳中: {display_name} (mime={mime_type})")
 
         operation = self.client.file_search_stores.upload_to_file_search_store(
-            file=file_path,
+            file=file,
             file_search_store_name=store_name,
             config={"display_name": display_name, "mime_type": mime_type},
         )
@@ -277,27 +321,55 @@ class FileSearchManager:
         Returns:
             GenerateContentResponse 物件
         """
-        # 建立 config
-        si = None
-        if system_instruction:
-            si = [types.Part.from_text(text=system_instruction)]
-
         response = self.client.models.generate_content(
             model=model,
             contents=question,
-            config=types.GenerateContentConfig(
-                tools=[
-                    types.Tool(
-                        file_search=types.FileSearch(
-                            file_search_store_names=[store_name]
-                        )
-                    )
-                ],
-                system_instruction=si
-            ),
+            config=self._query_config(store_name, system_instruction),
         )
         return response
 
+    def query_stream(
+        self,
+        store_name: str,
+        question: str,
+        model: str = "gemini-2.5-flash",
+        system_instruction: str | None = None,
+    ) -> Iterator[types.GenerateContentResponse]:
+        """使用 File Search 查詢，以串流方式逐段回傳結果。
+
+        Args:
+            store_name: Store 資源名稱
+            question: 問題
+            model: 使用的模型名稱
+            system_instruction: 系統指令（選填）
+
+        Returns:
+            GenerateContentResponse 片段的 iterator
+        """
+        return self.client.models.generate_content_stream(
+            model=model,
+            contents=question,
+            config=self._query_config(store_name, system_instruction),
+        )
+
+    def _query_config(
+        self, store_name: str, system_instruction: str | None
+    ) -> types.GenerateContentConfig:
+        """建立 File Search 查詢用的 config。"""
+        si = None
+        if system_instruction:
+            si = [types.Part.from_text(text=system_instruction)]
+
+        return types.GenerateContentConfig(
+            tools=[
+                types.Tool(
+                    file_search=types.FileSearch(
+                        file_search_store_names=[store_name]
+                    )
+                )
+            ],
+            system_instruction=si
+        )
 
 def main():
     """主程式進入點。"""
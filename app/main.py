@@ -2,16 +2,24 @@
 Gemini File Search FastAPI 後端
 """
 
+import asyncio
+import atexit
+import functools
+import json
 import logging
-import traceback
+import logging.handlers
 import os
-import shutil
+import queue
+import re
+import threading
+import time
 import uuid
-from pathlib import Path
-from typing import Optional
+from collections import OrderedDict
+from typing import Iterator, Optional
 
 # 設定 uvicorn 日誌格式（加上時間戳，保留顏色，狀態碼上色）
 import uvicorn.logging
+from dotenv import load_dotenv
 
 # ANSI 顏色碼
 GREEN = "\033[32m"
@@ -19,44 +27,98 @@ YELLOW = "\033[33m"
 RED = "\033[31m"
 RESET = "\033[0m"
 
+# 需要上色的 HTTP 狀態碼
+STATUS_COLOR = {
+    "200": GREEN, "201": GREEN,
+    "400": RED, "401": RED, "403": RED, "404": RED,
+    "429": YELLOW,
+    "500": RED, "502": RED, "503": RED,
+}
+STATUS_RE = re.compile(r" ([1-5]\d\d)\b")
+
+
+def _colour_status(match: re.Match) -> str:
+    """依狀態碼回傳上色後的字串，未列入對照表的保持原樣。"""
+    code = match.group(1)
+    colour = STATUS_COLOR.get(code)
+    if colour is None:
+        return match.group(0)
+    return f" {colour}{code}{RESET}"
+
+
+# 時間戳快取 (秒數, 格式化字串)，同一秒內的日誌共用，strftime 每秒只執行一次
+# 以單一 tuple 整體替換，多執行緒同時格式化時不會讀到新舊混雜的值
+_ts_cache = (0, "")
+
+
 class TimestampFormatter(uvicorn.logging.ColourizedFormatter):
     """在 uvicorn 原有的彩色格式前加上時間戳，並對狀態碼上色。"""
     def formatMessage(self, record):
-        from datetime import datetime
-        timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-        original = super().formatMessage(record)
+        global _ts_cache
+        second = int(record.created)
+        cached_second, timestamp = _ts_cache
+        if second != cached_second:
+            timestamp = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(second))
+            _ts_cache = (second, timestamp)
 
         # 對 HTTP 狀態碼上色
-        msg = original
-        if " 200" in msg or " 201" in msg:
-            msg = msg.replace(" 200", f" {GREEN}200{RESET}").replace(" 201", f" {GREEN}201{RESET}")
-        elif " 404" in msg or " 400" in msg or " 401" in msg or " 403" in msg:
-            msg = msg.replace(" 404", f" {RED}404{RESET}").replace(" 400", f" {RED}400{RESET}")
-            msg = msg.replace(" 401", f" {RED}401{RESET}").replace(" 403", f" {RED}403{RESET}")
-        elif " 500" in msg or " 502" in msg or " 503" in msg:
-            msg = msg.replace(" 500", f" {RED}500{RESET}").replace(" 502", f" {RED}502{RESET}")
-            msg = msg.replace(" 503", f" {RED}503{RESET}")
-        elif " 429" in msg:
-            msg = msg.replace(" 429", f" {YELLOW}429{RESET}")
-
+        msg = STATUS_RE.sub(_colour_status, super().formatMessage(record))
         return f"[{timestamp}] {msg}"
 
+
+class _RecordQueueHandler(logging.handlers.QueueHandler):
+    """只把 record 放進 queue，格式化完全交給背景的 QueueListener。
+
+    預設的 prepare() 會在呼叫端先格式化並清掉 args，
+    但 uvicorn 的 access formatter 需要 args，且同一行程內不需要序列化。
+    """
+    def prepare(self, record):
+        return record
+
+
+# 先載入 .env，讓下列日誌設定也能從 .env 讀取
+load_dotenv()
+
+# 日誌等級 (預設 WARNING，開發時可設為 INFO 以顯示 access log，DEBUG 顯示除錯訊息)
+# 會覆蓋 uvicorn 的 --log-level 設定；無效的值一律退回 WARNING
+LOG_LEVEL = os.getenv("LOG_LEVEL", "WARNING").upper()
+if LOG_LEVEL not in logging.getLevelNamesMapping():
+    LOG_LEVEL = "WARNING"
+# 是否以背景執行緒輸出日誌，請求路徑只需 enqueue
+ASYNC_LOG = os.getenv("ASYNC_LOG", "true").lower() in ("1", "true", "yes")
+
+# 應用程式自身的 logger，與 uvicorn 共用格式與輸出方式
+log = logging.getLogger("app")
+if not log.handlers:
+    log.addHandler(logging.StreamHandler())
+log.propagate = False
+
 # 覆蓋 uvicorn 的 logger 格式
-for logger_name in ("uvicorn", "uvicorn.access", "uvicorn.error"):
+for logger_name in ("uvicorn", "uvicorn.access", "uvicorn.error", "app"):
     uvicorn_logger = logging.getLogger(logger_name)
+    uvicorn_logger.setLevel(LOG_LEVEL)
     for handler in uvicorn_logger.handlers:
         handler.setFormatter(TimestampFormatter("%(levelprefix)s %(message)s"))
 
-from fastapi import FastAPI, File, HTTPException, UploadFile, Request, Header as FastAPIHeader
+    if ASYNC_LOG and uvicorn_logger.handlers:
+        log_queue = queue.SimpleQueue()
+        listener = logging.handlers.QueueListener(
+            log_queue, *uvicorn_logger.handlers, respect_handler_level=True
+        )
+        uvicorn_logger.handlers = [_RecordQueueHandler(log_queue)]
+        listener.start()
+        atexit.register(listener.stop)
+
+from fastapi import Depends, FastAPI, File, HTTPException, UploadFile, Request, Header as FastAPIHeader
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import JSONResponse
+from fastapi.responses import JSONResponse, StreamingResponse
 from pydantic import BaseModel
 from google.genai.errors import ClientError
-from typing import Dict
 import hashlib
 
 from .core import FileSearchManager
 from .api_keys import APIKeyManager
+from .prompts import PromptManager
 
 app = FastAPI(title="Gemini File Search API")
 
@@ -64,7 +126,7 @@ app = FastAPI(title="Gemini File Search API")
 async def gemini_client_error_handler(request: Request, exc: ClientError):
     """處理 Google GenAI Client 錯誤 (例如 429 配額不足)。"""
     error_msg = str(exc)
-    print(f"[Gemini API Error] {error_msg}")  # 打印完整錯誤
+    log.warning("[Gemini API Error] %s", error_msg)  # 記錄完整錯誤
 
     status_code = 500
     detail = "Google API Error"
@@ -89,10 +151,54 @@ app.add_middleware(
 )
 
 manager: FileSearchManager | None = None
-prompt_manager = None
+prompt_manager: PromptManager | None = None
 api_key_manager: APIKeyManager | None = None
-# Session managers: {session_id: FileSearchManager}
-user_managers: Dict[str, FileSearchManager] = {}
+
+
+class ManagerCache:
+    """有容量上限的 LRU，存放每個使用者 API Key 對應的 Manager。
+
+    超過上限時淘汰最久未使用的 Manager。淘汰時只移除參照，不主動關閉連線，
+    因為仍可能有進行中的請求在使用它；待沒有請求持有時由 GC 回收並關閉 Client。
+    """
+
+    def __init__(self, maxsize: int = 256):
+        self.maxsize = maxsize
+        self._d: OrderedDict[str, FileSearchManager] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, session_id: str) -> Optional[FileSearchManager]:
+        """取得 Manager 並標記為最近使用，不存在時回傳 None。"""
+        with self._lock:
+            mgr = self._d.get(session_id)
+            if mgr is not None:
+                self._d.move_to_end(session_id)
+            return mgr
+
+    def put(self, session_id: str, mgr: FileSearchManager) -> None:
+        """加入 Manager，超過上限時淘汰最久未使用者。"""
+        with self._lock:
+            self._d[session_id] = mgr
+            self._d.move_to_end(session_id)
+            evicted = []
+            while len(self._d) > self.maxsize:
+                evicted.append(self._d.popitem(last=False)[0])
+        for sid in evicted:
+            log.info("[Session] 釋放使用者 Manager: %.8s...", sid)
+
+    def close_all(self) -> None:
+        """清空快取並關閉所有 Manager 的連線 (僅在應用程式關閉時呼叫)。"""
+        with self._lock:
+            managers = list(self._d.values())
+            self._d.clear()
+        for mgr in managers:
+            mgr.close()
+
+
+# 最多同時保留的使用者 Manager 數量
+MAX_USER_MANAGERS = int(os.getenv("MAX_USER_MANAGERS", 256))
+# Session managers: {session_id: FileSearchManager}，最多保留 MAX_USER_MANAGERS 個
+user_managers = ManagerCache(maxsize=MAX_USER_MANAGERS)
 
 
 @app.on_event("startup")
@@ -101,32 +207,76 @@ def startup():
     global manager, prompt_manager, api_key_manager
     try:
         manager = FileSearchManager()
-        from .prompts import PromptManager
         prompt_manager = PromptManager()
         api_key_manager = APIKeyManager()
     except ValueError as e:
-        print(f"警告: {e}")
+        log.warning("警告: %s", e)
+
+
+@app.on_event("shutdown")
+def shutdown():
+    """應用程式關閉時釋放所有 Manager 的連線。"""
+    user_managers.close_all()
+    if manager:
+        manager.close()
+
 
+# 快取大小與 user_managers 相同，避免原始 API Key 在 Manager 被淘汰後仍長期留在記憶體
+@functools.lru_cache(maxsize=MAX_USER_MANAGERS)
+def _key_digest(api_key: str) -> str:
+    """計算 API Key 的 SHA-256 (快取結果，同一把 key 只計算一次)"""
+    return hashlib.sha256(api_key.encode()).hexdigest()
 
-def _get_or_create_manager(user_api_key: Optional[str] = None) -> FileSearchManager:
+
+async def _get_or_create_manager(user_api_key: str) -> FileSearchManager:
     """根據使用者提供的 API Key 取得或建立 Manager"""
-    if not user_api_key:
-        # 沒有提供 API Key，使用預設的全域 manager
-        if not manager:
-            raise HTTPException(status_code=500, detail="未設定 API Key")
-        return manager
-    
     # 使用 API Key 的 hash 作為 session ID
-    session_id = hashlib.sha256(user_api_key.encode()).hexdigest()
-    
-    if session_id not in user_managers:
-        try:
-            user_managers[session_id] = FileSearchManager(api_key=user_api_key)
-            print(f"[Session] 建立新的使用者 Manager: {session_id[:8]}...")
-        except ValueError as e:
-            raise HTTPException(status_code=400, detail=f"無效的 API Key: {e}")
-    
-    return user_managers[session_id]
+    session_id = _key_digest(user_api_key)
+    mgr = user_managers.get(session_id)
+    if mgr is not None:
+        return mgr
+
+    try:
+        # 建立 genai.Client 需初始化 httpx/SSL (約數十 ms)，放到 thread 避免阻塞 event loop
+        mgr = await asyncio.to_thread(FileSearchManager, api_key=user_api_key)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=f"無效的 API Key: {e}")
+    user_managers.put(session_id, mgr)
+    log.info("[Session] 建立新的使用者 Manager: %.8s...", session_id)
+    return mgr
+
+
+async def require_manager() -> FileSearchManager:
+    """FastAPI 依賴：取得預設的全域 Manager"""
+    if manager is None:
+        raise HTTPException(status_code=500, detail="未設定 Gemini API Key")
+    return manager
+
+
+async def require_prompt_manager() -> PromptManager:
+    """FastAPI 依賴：取得 Prompt Manager"""
+    if prompt_manager is None:
+        raise HTTPException(status_code=500, detail="Prompt Manager 未初始化")
+    return prompt_manager
+
+
+async def require_api_key_manager() -> APIKeyManager:
+    """FastAPI 依賴：取得 API Key Manager"""
+    if api_key_manager is None:
+        raise HTTPException(status_code=500, detail="API Key Manager 未初始化")
+    return api_key_manager
+
+
+async def resolve_manager(x_gemini_api_key: Optional[str] = FastAPIHeader(None)) -> FileSearchManager:
+    """FastAPI 依賴：依 X-Gemini-Api-Key header 解析本次請求使用的 Manager
+
+    宣告為 async：快取命中時只做字典查詢，不佔用 threadpool；
+    未命中時才把 Manager 的建立交給 thread 執行
+    """
+    if not x_gemini_api_key:
+        # 沒有提供 API Key，使用預設的全域 manager
+        return await require_manager()
+    return await _get_or_create_manager(x_gemini_api_key)
 
 
 class CreateStoreRequest(BaseModel):
@@ -148,113 +298,91 @@ class ChatMessageRequest(BaseModel):
 
 
 @app.get("/api/stores")
-def list_stores(x_gemini_api_key: Optional[str] = FastAPIHeader(None)):
+async def list_stores(mgr: FileSearchManager = Depends(resolve_manager)):
     """列出所有 Store。"""
-    mgr = _get_or_create_manager(x_gemini_api_key)
-    stores = mgr.list_stores()
+    stores = await asyncio.to_thread(mgr.list_stores)
     return [{"name": s.name, "display_name": s.display_name} for s in stores]
 
 
 @app.post("/api/stores")
-def create_store(req: CreateStoreRequest, x_gemini_api_key: Optional[str] = FastAPIHeader(None)):
+def create_store(req: CreateStoreRequest, mgr: FileSearchManager = Depends(resolve_manager)):
     """建立新 Store。"""
-    mgr = _get_or_create_manager(x_gemini_api_key)
     store_name = mgr.create_store(req.display_name)
     return {"name": store_name}
 
 
 @app.get("/api/stores/{store_name:path}/files")
-def list_files(store_name: str, x_gemini_api_key: Optional[str] = FastAPIHeader(None)):
+async def list_files(store_name: str, mgr: FileSearchManager = Depends(resolve_manager)):
     """列出 Store 中的檔案。"""
-    mgr = _get_or_create_manager(x_gemini_api_key)
-    files = mgr.list_files(store_name)
+    files = await asyncio.to_thread(mgr.list_files, store_name)
     return [{"name": f.name, "display_name": f.display_name} for f in files]
 
 
-import traceback
-
-# ... imports ...
-
 @app.delete("/api/files/{file_name:path}")
-def delete_file(file_name: str, x_gemini_api_key: Optional[str] = FastAPIHeader(None)):
+def delete_file(file_name: str, mgr: FileSearchManager = Depends(resolve_manager)):
     """刪除檔案。"""
-    mgr = _get_or_create_manager(x_gemini_api_key)
     try:
-        print(f"嘗試刪除檔案: {file_name}")
+        log.debug("嘗試刪除檔案: %s", file_name)
         mgr.delete_file(file_name)
         return {"ok": True}
     except Exception as e:
-        traceback.print_exc()  # Print full traceback to logs
+        log.exception("刪除檔案失敗: %s", file_name)
         raise HTTPException(status_code=500, detail=str(e))
 
 
 @app.post("/api/stores/{store_name:path}/upload")
-async def upload_file(store_name: str, file: UploadFile = File(...), x_gemini_api_key: Optional[str] = FastAPIHeader(None)):
+async def upload_file(store_name: str, file: UploadFile = File(...), mgr: FileSearchManager = Depends(resolve_manager)):
     """上傳檔案到 Store。"""
-    mgr = _get_or_create_manager(x_gemini_api_key)
-
-    temp_dir = Path("/tmp/gemini-upload")
-    temp_dir.mkdir(exist_ok=True)
-    # 使用 UUID + 副檔名，讓 SDK 能偵測 MIME type
-    ext = Path(file.filename).suffix if file.filename else ""
-    safe_filename = f"{uuid.uuid4()}{ext}"
-    temp_path = temp_dir / safe_filename
-
-    with open(temp_path, "wb") as f:
-        shutil.copyfileobj(file.file, f)
-
-    try:
-        # 故意不傳入 file.content_type，讓 core.py 根據副檔名自己判斷正確的 MIME Type
-        # 這樣可以避免瀏覽器傳送錯誤的 MIME Type (例如 xlsx 被當成 application/octet-stream)
-        result = mgr.upload_file(
-            store_name, str(temp_path), file.filename, mime_type=None
-        )
-        return {"name": result}
-    finally:
-        temp_path.unlink(missing_ok=True)
+    # 故意不傳入 file.content_type，讓 core.py 根據副檔名自己判斷正確的 MIME Type
+    # 這樣可以避免瀏覽器傳送錯誤的 MIME Type (例如 xlsx 被當成 application/octet-stream)
+    # SDK 上傳與輪詢為阻塞呼叫，放到 thread 執行
+    # file.file 是 Starlette 已暫存好的 SpooledTemporaryFile (超過 1MB 時已在磁碟上)，
+    # 不論大小都直接交給 SDK，不再複製
+    await file.seek(0)
+    result = await asyncio.to_thread(
+        mgr.upload_file_stream, store_name, file.file, file.filename or "upload", mime_type=None
+    )
+    return {"name": result}
 
 
 @app.post("/api/query")
-def query(req: QueryRequest, x_gemini_api_key: Optional[str] = FastAPIHeader(None)):
+async def query(req: QueryRequest, mgr: FileSearchManager = Depends(resolve_manager)):
     """查詢 Store (單次)。"""
-    mgr = _get_or_create_manager(x_gemini_api_key)
-    response = mgr.query(req.store_name, req.question)
+    response = await asyncio.to_thread(mgr.query, req.store_name, req.question)
     return {"answer": response.text}
 
 
 @app.post("/api/chat/start")
-def start_chat(req: ChatStartRequest, x_gemini_api_key: Optional[str] = FastAPIHeader(None)):
+async def start_chat(req: ChatStartRequest, mgr: FileSearchManager = Depends(resolve_manager)):
     """開始新的對話 Session。"""
-    mgr = _get_or_create_manager(x_gemini_api_key)
-    
     # 取得啟用的 prompt (如果有)
     system_instruction = None
     if prompt_manager:
-        active_prompt = prompt_manager.get_active_prompt(req.store_name)
+        active_prompt = await asyncio.to_thread(prompt_manager.get_active_prompt, req.store_name)
         if active_prompt:
             system_instruction = active_prompt.content
-            print(f"[DEBUG] 從 MongoDB 載入 Prompt: {active_prompt.name}")
+            log.debug("從 MongoDB 載入 Prompt: %s", active_prompt.name)
         else:
-            print(f"[DEBUG] Store {req.store_name} 沒有啟用的 Prompt")
+            log.debug("Store %s 沒有啟用的 Prompt", req.store_name)
     
-    mgr.start_chat(req.store_name, req.model, system_instruction=system_instruction)
+    await asyncio.to_thread(
+        mgr.start_chat, req.store_name, req.model, system_instruction=system_instruction
+    )
     return {"ok": True, "prompt_applied": system_instruction is not None}
 
 @app.post("/api/chat/message")
-def send_message(req: ChatMessageRequest, x_gemini_api_key: Optional[str] = FastAPIHeader(None)):
+async def send_message(req: ChatMessageRequest, mgr: FileSearchManager = Depends(resolve_manager)):
     """發送訊息到目前對話。"""
-    mgr = _get_or_create_manager(x_gemini_api_key)
     try:
-        response = mgr.send_message(req.message)
+        response = await asyncio.to_thread(mgr.send_message, req.message)
         return {"answer": response.text}
     except ValueError as e:
         raise HTTPException(status_code=400, detail=str(e))
 
 
 @app.get("/api/chat/history")
-def get_history(x_gemini_api_key: Optional[str] = FastAPIHeader(None)):
+async def get_history(mgr: FileSearchManager = Depends(resolve_manager)):
     """取得目前對話紀錄。"""
-    mgr = _get_or_create_manager(x_gemini_api_key)
     return mgr.get_history()
 
 
@@ -297,7 +425,7 @@ def _extract_bearer_token(request: Request) -> Optional[str]:
     return None
 
 
-def _get_system_prompt(api_key_info, store_name: str, messages: list) -> Optional[str]:
+def _get_system_prompt(api_key_info, store_name: str, system_message: Optional[OpenAIChatMessage]) -> Optional[str]:
     """
     根據優先順序決定使用哪個 system prompt:
     1. Request 帶的 system message → 最優先
@@ -306,9 +434,8 @@ def _get_system_prompt(api_key_info, store_name: str, messages: list) -> Optiona
     4. 都沒有 → None
     """
     # 1. 檢查 request 中的 system message
-    system_messages = [msg for msg in messages if msg.role == "system"]
-    if system_messages:
-        return system_messages[-1].content
+    if system_message is not None:
+        return system_message.content
 
     if not prompt_manager:
         return None
@@ -327,44 +454,100 @@ def _get_system_prompt(api_key_info, store_name: str, messages: list) -> Optiona
     return None
 
 
+def _sse_chunk(completion_id: str, created: int, model: str, delta: dict, finish_reason: Optional[str] = None) -> str:
+    """組成一筆 OpenAI chat.completion.chunk 格式的 SSE 事件"""
+    chunk = {
+        "id": completion_id,
+        "object": "chat.completion.chunk",
+        "created": created,
+        "model": model,
+        "choices": [{"index": 0, "delta": delta, "finish_reason": finish_reason}],
+    }
+    return f"data: {json.dumps(chunk, ensure_ascii=False)}\n\n"
+
+
+def _stream_chat_completion(
+    mgr: FileSearchManager,
+    store_name: str,
+    question: str,
+    system_prompt: Optional[str],
+    model_name: str,
+    warning: Optional[str],
+) -> Iterator[str]:
+    """
+    以 SSE 逐段輸出 Gemini 回覆 (OpenAI stream 格式)
+
+    為同步 generator，StreamingResponse 會在 threadpool 中迭代，不會阻塞 event loop
+    """
+    completion_id = f"chatcmpl-{uuid.uuid4().hex[:8]}"
+    created = int(time.time())
+
+    yield _sse_chunk(completion_id, created, model_name, {"role": "assistant", "content": ""})
+    if warning:
+        yield _sse_chunk(completion_id, created, model_name, {"content": f"⚠️ {warning}\n\n"})
+
+    try:
+        for part in mgr.query_stream(
+            store_name, question, system_instruction=system_prompt, model=model_name
+        ):
+            if part.text:
+                yield _sse_chunk(completion_id, created, model_name, {"content": part.text})
+    except Exception as e:
+        # 串流已開始，無法再改變 status code，改以 error 事件通知 client
+        yield f"data: {json.dumps({'error': {'message': str(e)}}, ensure_ascii=False)}\n\n"
+    else:
+        yield _sse_chunk(completion_id, created, model_name, {}, finish_reason="stop")
+
+    yield "data: [DONE]\n\n"
+
+
 @app.post("/v1/chat/completions")
-async def openai_chat_completions(request: OpenAIChatRequest, raw_request: Request):
+async def openai_chat_completions(
+    request: OpenAIChatRequest,
+    raw_request: Request,
+    mgr: FileSearchManager = Depends(require_manager),
+    km: APIKeyManager = Depends(require_api_key_manager),
+):
     """
     OpenAI 兼容的 Chat Completions API
 
     使用 Authorization: Bearer sk-xxx 驗證，API Key 綁定知識庫
+    stream=true 時以 SSE (text/event-stream) 逐段回傳
 
     Prompt 優先順序:
     1. Request 帶的 system message
     2. API Key 指定的 prompt_index
     3. 知識庫的預設 prompt
     """
-    if not manager:
-        raise HTTPException(status_code=500, detail="未設定 Gemini API Key")
-
-    if not api_key_manager:
-        raise HTTPException(status_code=500, detail="API Key Manager 未初始化")
-
     # 驗證 API Key
     token = _extract_bearer_token(raw_request)
     if not token:
         raise HTTPException(status_code=401, detail="缺少 Authorization header")
 
-    api_key_info = api_key_manager.verify_key(token)
+    api_key_info = await asyncio.to_thread(km.verify_key, token)
     if not api_key_info:
         raise HTTPException(status_code=401, detail="無效的 API Key")
 
     store_name = api_key_info.store_name
 
-    # 取得最後一條用戶消息
-    user_messages = [msg for msg in request.messages if msg.role == "user"]
-    if not user_messages:
+    # 單次掃描取得最後一條用戶消息與 system message
+    last_user = None
+    last_system = None
+    for msg in request.messages:
+        if msg.role == "user":
+            last_user = msg
+        elif msg.role == "system":
+            last_system = msg
+
+    if last_user is None:
         raise HTTPException(status_code=400, detail="沒有找到用戶消息")
 
-    last_message = user_messages[-1].content
+    last_message = last_user.content
 
     # 決定 system prompt
-    system_prompt = _get_system_prompt(api_key_info, store_name, request.messages)
+    system_prompt = await asyncio.to_thread(
+        _get_system_prompt, api_key_info, store_name, last_system
+    )
 
     # 驗證 model 並決定實際使用的模型
     warning = None
@@ -374,16 +557,26 @@ async def openai_chat_completions(request: OpenAIChatRequest, raw_request: Reque
         model_name = DEFAULT_MODEL
         warning = f"不支援的模型 '{request.model}'，已改用預設模型 '{DEFAULT_MODEL}'。支援的模型: {', '.join(SUPPORTED_MODELS)}"
 
+    if request.stream:
+        return StreamingResponse(
+            _stream_chat_completion(mgr, store_name, last_message, system_prompt, model_name, warning),
+            media_type="text/event-stream",
+            # 避免反向代理 (如 nginx) 緩衝事件串流
+            headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+        )
+
     try:
         # 使用 query 進行單次 RAG 查詢（不依賴 session）
-        response = manager.query(store_name, last_message, system_instruction=system_prompt, model=model_name)
+        # SDK 呼叫為阻塞式網路請求，放到 thread 執行以免卡住 event loop
+        response = await asyncio.to_thread(
+            mgr.query, store_name, last_message, system_instruction=system_prompt, model=model_name
+        )
 
         # 如果有警告，附加到回覆開頭
         answer_text = response.text
         if warning:
             answer_text = f"⚠️ {warning}\n\n{answer_text}"
 
-        import time
         result = OpenAIChatResponse(
             id=f"chatcmpl-{uuid.uuid4().hex[:8]}",
             created=int(time.time()),
@@ -426,29 +619,23 @@ class SetActivePromptRequest(BaseModel):
 
 
 @app.get("/api/stores/{store_name:path}/prompts")
-def list_store_prompts(store_name: str):
+async def list_store_prompts(store_name: str, pm: PromptManager = Depends(require_prompt_manager)):
     """列出 Store 的所有 Prompts"""
-    if not prompt_manager:
-        raise HTTPException(status_code=500, detail="Prompt Manager 未初始化")
-    
-    prompts = prompt_manager.list_prompts(store_name)
-    active_prompt = prompt_manager.get_active_prompt(store_name)
+    prompts = await asyncio.to_thread(pm.list_prompts, store_name)
+    active_prompt = await asyncio.to_thread(pm.get_active_prompt, store_name)
     
     return {
         "prompts": [p.model_dump() for p in prompts],
         "active_prompt_id": active_prompt.id if active_prompt else None,
-        "max_prompts": prompt_manager.MAX_PROMPTS_PER_STORE
+        "max_prompts": pm.MAX_PROMPTS_PER_STORE
     }
 
 
 @app.post("/api/stores/{store_name:path}/prompts")
-def create_store_prompt(store_name: str, request: CreatePromptRequest):
+def create_store_prompt(store_name: str, request: CreatePromptRequest, pm: PromptManager = Depends(require_prompt_manager)):
     """建立新的 Prompt"""
-    if not prompt_manager:
-        raise HTTPException(status_code=500, detail="Prompt Manager 未初始化")
-    
     try:
-        prompt = prompt_manager.create_prompt(
+        prompt = pm.create_prompt(
             store_name=store_name,
             name=request.name,
             content=request.content
@@ -459,12 +646,9 @@ def create_store_prompt(store_name: str, request: CreatePromptRequest):
 
 
 @app.get("/api/stores/{store_name:path}/prompts/{prompt_id}")
-def get_store_prompt(store_name: str, prompt_id: str):
+async def get_store_prompt(store_name: str, prompt_id: str, pm: PromptManager = Depends(require_prompt_manager)):
     """取得特定 Prompt"""
-    if not prompt_manager:
-        raise HTTPException(status_code=500, detail="Prompt Manager 未初始化")
-    
-    prompt = prompt_manager.get_prompt(store_name, prompt_id)
+    prompt = await asyncio.to_thread(pm.get_prompt, store_name, prompt_id)
     if not prompt:
         raise HTTPException(status_code=404, detail="Prompt 不存在")
     
@@ -472,13 +656,10 @@ def get_store_prompt(store_name: str, prompt_id: str):
 
 
 @app.put("/api/stores/{store_name:path}/prompts/{prompt_id}")
-def update_store_prompt(store_name: str, prompt_id: str, request: UpdatePromptRequest):
+def update_store_prompt(store_name: str, prompt_id: str, request: UpdatePromptRequest, pm: PromptManager = Depends(require_prompt_manager)):
     """更新 Prompt"""
-    if not prompt_manager:
-        raise HTTPException(status_code=500, detail="Prompt Manager 未初始化")
-    
     try:
-        prompt = prompt_manager.update_prompt(
+        prompt = pm.update_prompt(
             store_name=store_name,
             prompt_id=prompt_id,
             name=request.name,
@@ -490,38 +671,29 @@ def update_store_prompt(store_name: str, prompt_id: str, request: UpdatePromptRe
 
 
 @app.delete("/api/stores/{store_name:path}/prompts/{prompt_id}")
-def delete_store_prompt(store_name: str, prompt_id: str):
+def delete_store_prompt(store_name: str, prompt_id: str, pm: PromptManager = Depends(require_prompt_manager)):
     """刪除 Prompt"""
-    if not prompt_manager:
-        raise HTTPException(status_code=500, detail="Prompt Manager 未初始化")
-    
     try:
-        prompt_manager.delete_prompt(store_name, prompt_id)
+        pm.delete_prompt(store_name, prompt_id)
         return {"message": "Prompt 已刪除"}
     except ValueError as e:
         raise HTTPException(status_code=404, detail=str(e))
 
 
 @app.post("/api/stores/{store_name:path}/prompts/active")
-def set_active_store_prompt(store_name: str, request: SetActivePromptRequest):
+def set_active_store_prompt(store_name: str, request: SetActivePromptRequest, pm: PromptManager = Depends(require_prompt_manager)):
     """設定啟用的 Prompt"""
-    if not prompt_manager:
-        raise HTTPException(status_code=500, detail="Prompt Manager 未初始化")
-    
     try:
-        prompt_manager.set_active_prompt(store_name, request.prompt_id)
+        pm.set_active_prompt(store_name, request.prompt_id)
         return {"message": "已設定啟用的 Prompt", "prompt_id": request.prompt_id}
     except ValueError as e:
         raise HTTPException(status_code=404, detail=str(e))
 
 
 @app.get("/api/stores/{store_name:path}/prompts/active")
-def get_active_store_prompt(store_name: str):
+async def get_active_store_prompt(store_name: str, pm: PromptManager = Depends(require_prompt_manager)):
     """取得當前啟用的 Prompt"""
-    if not prompt_manager:
-        raise HTTPException(status_code=500, detail="Prompt Manager 未初始化")
-    
-    prompt = prompt_manager.get_active_prompt(store_name)
+    prompt = await asyncio.to_thread(pm.get_active_prompt, store_name)
     if not prompt:
         return {"message": "尚未設定啟用的 Prompt", "prompt": None}
     
@@ -529,9 +701,8 @@ def get_active_store_prompt(store_name: str):
 
 
 @app.delete("/api/stores/{store_name:path}")
-def delete_store(store_name: str, x_gemini_api_key: Optional[str] = FastAPIHeader(None)):
+def delete_store(store_name: str, mgr: FileSearchManager = Depends(resolve_manager)):
     """刪除 Store。"""
-    mgr = _get_or_create_manager(x_gemini_api_key)
     mgr.delete_store(store_name)
     return {"ok": True}
 
@@ -550,12 +721,9 @@ class UpdateAPIKeyRequest(BaseModel):
 
 
 @app.get("/api/keys")
-def list_api_keys(store_name: Optional[str] = None):
+async def list_api_keys(store_name: Optional[str] = None, km: APIKeyManager = Depends(require_api_key_manager)):
     """列出 API Keys，可選篩選特定知識庫"""
-    if not api_key_manager:
-        raise HTTPException(status_code=500, detail="API Key Manager 未初始化")
-
-    keys = api_key_manager.list_keys(store_name)
+    keys = await asyncio.to_thread(km.list_keys, store_name)
     # 不返回 key_hash
     return [
         {
@@ -572,12 +740,9 @@ def list_api_keys(store_name: Optional[str] = None):
 
 
 @app.post("/api/keys")
-def create_api_key(request: CreateAPIKeyRequest):
+def create_api_key(request: CreateAPIKeyRequest, km: APIKeyManager = Depends(require_api_key_manager)):
     """建立新的 API Key"""
-    if not api_key_manager:
-        raise HTTPException(status_code=500, detail="API Key Manager 未初始化")
-
-    api_key, raw_key = api_key_manager.create_key(
+    api_key, raw_key = km.create_key(
         name=request.name,
         store_name=request.store_name,
         prompt_index=request.prompt_index
@@ -595,12 +760,9 @@ def create_api_key(request: CreateAPIKeyRequest):
 
 
 @app.get("/api/keys/{key_id}")
-def get_api_key(key_id: str):
+async def get_api_key(key_id: str, km: APIKeyManager = Depends(require_api_key_manager)):
     """取得 API Key 資訊"""
-    if not api_key_manager:
-        raise HTTPException(status_code=500, detail="API Key Manager 未初始化")
-
-    key = api_key_manager.get_key(key_id)
+    key = await asyncio.to_thread(km.get_key, key_id)
     if not key:
         raise HTTPException(status_code=404, detail="API Key 不存在")
 
@@ -616,12 +778,9 @@ def get_api_key(key_id: str):
 
 
 @app.put("/api/keys/{key_id}")
-def update_api_key(key_id: str, request: UpdateAPIKeyRequest):
+def update_api_key(key_id: str, request: UpdateAPIKeyRequest, km: APIKeyManager = Depends(require_api_key_manager)):
     """更新 API Key 設定"""
-    if not api_key_manager:
-        raise HTTPException(status_code=500, detail="API Key Manager 未初始化")
-
-    key = api_key_manager.update_key(
+    key = km.update_key(
         key_id=key_id,
         name=request.name,
         prompt_index=request.prompt_index
@@ -640,12 +799,9 @@ def update_api_key(key_id: str, request: UpdateAPIKeyRequest):
 
 
 @app.delete("/api/keys/{key_id}")
-def delete_api_key(key_id: str):
+def delete_api_key(key_id: str, km: APIKeyManager = Depends(require_api_key_manager)):
     """刪除 API Key"""
-    if not api_key_manager:
-        raise HTTPException(status_code=500, detail="API Key Manager 未初始化")
-
-    success = api_key_manager.delete_key(key_id)
+    success = km.delete_key(key_id)
     if not success:
         raise HTTPException(status_code=404, detail="API Key 不存在")
 
@@ -653,6 +809,6 @@ def delete_api_key(key_id: str):
 
 
 @app.get("/")
-def index():
+async def index():
     """API 入口。"""
     return {"message": "Gemini File Search API", "docs": "/docs"}